@@ -4,14 +4,21 @@ import websocket
 import base64
 import json
 import uuid
+import functools
 import logging
-import urllib.request
-import urllib.parse
-import subprocess
+import mmap
+import shutil
+import socket
+import tempfile
+import threading
 import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
 import boto3
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config as BotoConfig
-from pathlib import Path
 
 # Logging setup
 logging.basicConfig(level=logging.INFO)
@@ -20,6 +27,65 @@ logger = logging.getLogger(__name__)
 server_address = os.getenv('SERVER_ADDRESS', '127.0.0.1')
 client_id = str(uuid.uuid4())
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+DOWNLOAD_TIMEOUT_SECONDS = 300
+DOWNLOAD_ABORT_GRACE_SECONDS = 5
+
+# Stage job inputs on tmpfs when available so they never touch the container disk
+input_staging_root = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+# Image input keys in priority order, mapped to their process_input type
+IMAGE_INPUT_TYPES = (
+    ("image_path", "path"),
+    ("image_url", "url"),
+    ("image_base64", "base64"),
+)
+
+WORKFLOW_FILE = "/workflows/wan22_api.json"
+
+DEFAULT_SEED = 42
+
+# Workflow inputs copied straight from the job: (node_id, input_name, job_input key, default)
+WORKFLOW_PATCHES = (
+    ("541", "num_frames", "num_frames", 81),
+    ("135", "positive_prompt", "prompt", "A beautiful video"),
+    ("220", "seed", "seed", DEFAULT_SEED),
+    ("540", "seed", "seed", DEFAULT_SEED),
+    ("540", "cfg", "cfg", 2.0),
+    ("498", "context_overlap", "context_overlap", 48),
+)
+
+# Persistent HTTP session so TCP/TLS connections stay warm between jobs
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+http_session.mount("http://", http_adapter)
+http_session.mount("https://", http_adapter)
+
+# Multipart settings for R2 uploads: split large videos into parts uploaded concurrently
+R2_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True,
+)
+
+# Shared botocore config; pool sized above the transfer concurrency so upload threads aren't starved
+R2_BOTO_CONFIG = BotoConfig(
+    s3={"addressing_style": "path"},
+    max_pool_connections=20,
+    tcp_keepalive=True,
+)
+
+# Time budget for each of the ComfyUI HTTP and websocket connection checks
+COMFYUI_CONNECT_TIMEOUT_SECONDS = 180
+
+# Background workers for the R2 upload and optional base64 encoding of the output video
+output_executor = ThreadPoolExecutor(max_workers=2)
+
+def retry_delay(attempt, initial_delay):
+    """Capped exponential backoff delay for connection retries."""
+    return min(initial_delay * 2 ** attempt, 2.0)
+
 def to_nearest_multiple_of_16(value):
     """Round value to nearest multiple of 16, minimum 16."""
     try:
@@ -47,25 +113,73 @@ def process_input(input_data, temp_dir, output_filename, input_type):
     else:
         raise Exception(f"Unsupported input type: {input_type}")
 
-def download_file_from_url(url, output_path):
-    """Download file from URL using wget."""
+def _stream_url_to_file(url, output_path, transfer):
+    """Stream URL to output_path in 1 MiB chunks, publishing the response and any error in transfer."""
     try:
-        result = subprocess.run([
-            'wget', '-O', output_path, '--no-verbose', url
-        ], capture_output=True, text=True, timeout=300)
-        
-        if result.returncode == 0:
-            logger.info(f"✅ Successfully downloaded file from URL: {url} -> {output_path}")
-            return output_path
-        else:
-            logger.error(f"❌ wget download failed: {result.stderr}")
-            raise Exception(f"URL download failed: {result.stderr}")
-    except subprocess.TimeoutExpired:
+        with http_session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT_SECONDS) as response:
+            with transfer["lock"]:
+                if transfer["aborted"]:
+                    return
+                transfer["response"] = response
+            response.raise_for_status()
+            # Read straight from the raw stream to skip iter_content's per-chunk overhead
+            response.raw.decode_content = True
+            with open(output_path, 'wb', buffering=DOWNLOAD_CHUNK_SIZE) as f:
+                while True:
+                    chunk = response.raw.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+    except Exception as e:
+        transfer["error"] = e
+
+def _abort_response(response):
+    """Shut down a streaming response's socket so a read blocked in another thread returns."""
+    # close() from this thread would wait on the blocked reader's buffer lock, and closing
+    # a descriptor does not wake a blocked recv; shutdown on a duplicate of it does
+    try:
+        sock = socket.socket(fileno=os.dup(response.raw.fileno()))
+    except (OSError, ValueError):
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+def download_file_from_url(url, output_path):
+    """Download file from URL within DOWNLOAD_TIMEOUT_SECONDS for the whole transfer."""
+    # requests timeouts only bound single socket operations, so a slow server could
+    # stall forever; run the transfer on a daemon thread and abort its socket at the deadline
+    transfer = {"lock": threading.Lock(), "aborted": False, "response": None, "error": None}
+    download_thread = threading.Thread(
+        target=_stream_url_to_file, args=(url, output_path, transfer), daemon=True
+    )
+    download_thread.start()
+    download_thread.join(DOWNLOAD_TIMEOUT_SECONDS)
+    
+    if download_thread.is_alive():
+        with transfer["lock"]:
+            transfer["aborted"] = True
+            response = transfer["response"]
+        if response is not None:
+            _abort_response(response)
+        download_thread.join(DOWNLOAD_ABORT_GRACE_SECONDS)
+        if download_thread.is_alive():
+            logger.warning("⚠️ Download thread still running after abort; leaving it to exit on its own")
         logger.error("❌ Download timeout")
         raise Exception("Download timeout")
-    except Exception as e:
-        logger.error(f"❌ Download error: {e}")
-        raise Exception(f"Download error: {e}")
+    
+    error = transfer["error"]
+    if error is None:
+        logger.info(f"✅ Successfully downloaded file from URL: {url} -> {output_path}")
+        return output_path
+    if isinstance(error, (requests.Timeout, ReadTimeoutError)):
+        logger.error("❌ Download timeout")
+        raise Exception("Download timeout")
+    logger.error(f"❌ Download error: {error}")
+    raise Exception(f"Download error: {error}")
 
 def save_base64_to_file(base64_data, temp_dir, output_filename):
     """Save Base64 data to file."""
@@ -86,25 +200,33 @@ def queue_prompt(prompt):
     url = f"http://{server_address}:8188/prompt"
     logger.info(f"Queueing prompt to: {url}")
     p = {"prompt": prompt, "client_id": client_id}
-    data = json.dumps(p).encode('utf-8')
-    req = urllib.request.Request(url, data=data)
-    return json.loads(urllib.request.urlopen(req).read())
+    response = http_session.post(url, json=p)
+    response.raise_for_status()
+    return response.json()
 
 def get_history(prompt_id):
     """Get history from ComfyUI."""
     url = f"http://{server_address}:8188/history/{prompt_id}"
     logger.info(f"Getting history from: {url}")
-    with urllib.request.urlopen(url) as response:
-        return json.loads(response.read())
+    response = http_session.get(url)
+    response.raise_for_status()
+    return response.json()
 
 def get_videos(ws, prompt):
-    """Get generated videos from ComfyUI via websocket."""
+    """Get generated video file paths from ComfyUI via websocket."""
     prompt_id = queue_prompt(prompt)['prompt_id']
     output_videos = {}
     
     while True:
         out = ws.recv()
         if isinstance(out, str):
+            # Skip progress frames and other prompts' traffic without parsing;
+            # only this prompt's final "executing" frame matters
+            if prompt_id not in out:
+                continue
+            # Spacing-independent screen; the parsed checks below are the real test
+            if '"executing"' not in out:
+                continue
             message = json.loads(out)
             if message['type'] == 'executing':
                 data = message['data']
@@ -119,20 +241,44 @@ def get_videos(ws, prompt):
         videos_output = []
         if 'gifs' in node_output:
             for video in node_output['gifs']:
-                # Read video file and encode as base64
-                with open(video['fullpath'], 'rb') as f:
-                    video_data = base64.b64encode(f.read()).decode('utf-8')
-                videos_output.append(video_data)
+                videos_output.append(video['fullpath'])
         output_videos[node_id] = videos_output
 
     return output_videos
 
+@functools.lru_cache(maxsize=None)
+def read_workflow_text(workflow_path):
+    """Read workflow JSON text from disk once and reuse it across jobs."""
+    with open(workflow_path, 'r') as file:
+        return file.read()
+
 def load_workflow(workflow_path):
     """Load workflow JSON file."""
-    with open(workflow_path, 'r') as file:
-        return json.load(file)
+    # Parsing the cached text gives each job a fresh copy faster than copy.deepcopy
+    return json.loads(read_workflow_text(workflow_path))
 
-def upload_output_video(video_base64: str) -> str:
+def encode_video_base64(video_path: str) -> str:
+    """Base64-encode a video file, streaming it from disk via mmap."""
+    with open(video_path, 'rb') as f:
+        # mmap rejects empty files
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return base64.b64encode(mm).decode('utf-8')
+
+@functools.lru_cache(maxsize=None)
+def _get_s3_client(endpoint_url, r2_key, r2_secret):
+    """Create the R2 S3 client once per configuration and reuse it across jobs."""
+    return boto3.client(
+        "s3",
+        endpoint_url=endpoint_url,
+        aws_access_key_id=r2_key,
+        aws_secret_access_key=r2_secret,
+        region_name="auto",
+        config=R2_BOTO_CONFIG
+    )
+
+def upload_output_video(video_path: str) -> str:
     """Upload video to R2 and return presigned URL."""
     logger.info("Preparing upload to R2")
     
@@ -147,21 +293,13 @@ def upload_output_video(video_base64: str) -> str:
         logger.warning("R2 not configured, skipping upload")
         return None
     
-    s3 = boto3.client(
-        "s3",
-        endpoint_url=endpoint_url,
-        aws_access_key_id=r2_key,
-        aws_secret_access_key=r2_secret,
-        region_name="auto",
-        config=BotoConfig(s3={"addressing_style": "path"})
-    )
+    s3 = _get_s3_client(endpoint_url, r2_key, r2_secret)
     
-    # Decode base64 video and upload
-    video_data = base64.b64decode(video_base64)
+    # Upload video file from disk in concurrent multipart chunks
     object_key = f"{upload_directory}/{uuid.uuid4()}.mp4"
     
     logger.info(f"Uploading to r2://{bucket_name}/{object_key}")
-    s3.put_object(Bucket=bucket_name, Key=object_key, Body=video_data)
+    s3.upload_file(video_path, bucket_name, object_key, Config=R2_TRANSFER_CONFIG)
     
     try:
         presigned_url = s3.generate_presigned_url(
@@ -175,24 +313,37 @@ def upload_output_video(video_base64: str) -> str:
         logger.error(f"Failed to generate presigned URL: {e}")
         return f"{endpoint_url}/{bucket_name}/{object_key}"
 
+def summarize_job_input(job_input):
+    """Return job input for logging, with inline base64 payloads replaced by their size."""
+    return {
+        key: f"<{len(value)} base64 chars>" if key == "image_base64" and isinstance(value, str) else value
+        for key, value in job_input.items()
+    }
+
 def handler(job):
     """RunPod serverless handler."""
     job_input = job.get("input", {})
-    logger.info(f"Received job input: {job_input}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Received job input: %s", summarize_job_input(job_input))
     
-    task_id = f"task_{uuid.uuid4()}"
+    task_dir = os.path.join(input_staging_root, f"task_{uuid.uuid4()}")
+    try:
+        return generate_video(job_input, task_dir)
+    finally:
+        # Staged inputs live in RAM on tmpfs, so always drop them after the job
+        shutil.rmtree(task_dir, ignore_errors=True)
 
+def generate_video(job_input, task_dir):
+    """Run the Wan2.2 workflow for one job, staging inputs under task_dir."""
     # Handle image input for I2V (image_path, image_url, image_base64)
     image_path = None
     task = job_input.get("task", "i2v")
     
-    # Try to get image from input (for I2V)
-    if "image_path" in job_input:
-        image_path = process_input(job_input["image_path"], task_id, "input_image.jpg", "path")
-    elif "image_url" in job_input:
-        image_path = process_input(job_input["image_url"], task_id, "input_image.jpg", "url")
-    elif "image_base64" in job_input:
-        image_path = process_input(job_input["image_base64"], task_id, "input_image.jpg", "base64")
+    # Try to get image from input (for I2V), first matching key wins
+    for input_key, input_type in IMAGE_INPUT_TYPES:
+        if input_key in job_input:
+            image_path = process_input(job_input[input_key], task_dir, "input_image.jpg", input_type)
+            break
     
     # If no image provided, use default (for T2V or when image is optional)
     if not image_path:
@@ -202,25 +353,20 @@ def handler(job):
         logger.info(f"Using input image: {image_path}")
     
     # Load workflow
-    workflow_file = "/workflows/wan22_api.json"
-    logger.info(f"Using workflow: {workflow_file}")
-    prompt = load_workflow(workflow_file)
+    logger.info(f"Using workflow: {WORKFLOW_FILE}")
+    prompt = load_workflow(WORKFLOW_FILE)
     
     # Apply parameters to workflow
-    length = job_input.get("num_frames", 81)
     steps = job_input.get("steps", 10)
-    seed = job_input.get("seed", 42)
-    cfg = job_input.get("cfg", 2.0)
     
     # Set image (always required for workflow)
     prompt["244"]["inputs"]["image"] = image_path
     
     # Set parameters in workflow
-    prompt["541"]["inputs"]["num_frames"] = length
-    prompt["135"]["inputs"]["positive_prompt"] = job_input.get("prompt", "A beautiful video")
-    prompt["220"]["inputs"]["seed"] = seed
-    prompt["540"]["inputs"]["seed"] = seed
-    prompt["540"]["inputs"]["cfg"] = cfg
+    for node_id, input_name, input_key, default in WORKFLOW_PATCHES:
+        prompt[node_id]["inputs"][input_name] = job_input.get(input_key, default)
+    # Report the frame count the workflow will actually run with
+    length = prompt["541"]["inputs"]["num_frames"]
     
     # Handle resolution (adjust to nearest 16 multiple)
     original_width = job_input.get("width", 480)
@@ -235,7 +381,6 @@ def handler(job):
     
     prompt["235"]["inputs"]["value"] = adjusted_width
     prompt["236"]["inputs"]["value"] = adjusted_height
-    prompt["498"]["inputs"]["context_overlap"] = job_input.get("context_overlap", 48)
     
     # Set steps
     if "834" in prompt:
@@ -275,56 +420,71 @@ def handler(job):
     http_url = f"http://{server_address}:8188/"
     logger.info(f"Checking HTTP connection to: {http_url}")
     
-    max_http_attempts = 180
-    for http_attempt in range(max_http_attempts):
+    http_deadline = time.monotonic() + COMFYUI_CONNECT_TIMEOUT_SECONDS
+    http_attempt = 0
+    while True:
         try:
+            http_session.get(http_url, timeout=1).raise_for_status()
             logger.info(f"HTTP connection successful (attempt {http_attempt+1})")
             break
         except Exception as e:
-            logger.warning(f"HTTP connection failed (attempt {http_attempt+1}/{max_http_attempts}): {e}")
-            if http_attempt == max_http_attempts - 1:
+            logger.warning(f"HTTP connection failed (attempt {http_attempt+1}): {e}")
+            remaining = http_deadline - time.monotonic()
+            if remaining <= 0:
                 raise Exception("Cannot connect to ComfyUI server. Check if server is running.")
-            time.sleep(1)
+            time.sleep(min(retry_delay(http_attempt, 0.1), remaining))
+            http_attempt += 1
     
     ws = websocket.WebSocket()
-    max_attempts = int(180/5)  # 3 minutes
-    for attempt in range(max_attempts):
+    ws_deadline = time.monotonic() + COMFYUI_CONNECT_TIMEOUT_SECONDS
+    attempt = 0
+    while True:
         try:
             ws.connect(ws_url)
             logger.info(f"Websocket connected successfully (attempt {attempt+1})")
             break
         except Exception as e:
-            logger.warning(f"Websocket connection failed (attempt {attempt+1}/{max_attempts}): {e}")
-            if attempt == max_attempts - 1:
-                raise Exception("Websocket connection timeout (3 minutes)")
-            time.sleep(5)
+            logger.warning(f"Websocket connection failed (attempt {attempt+1}): {e}")
+            remaining = ws_deadline - time.monotonic()
+            if remaining <= 0:
+                raise Exception(f"Websocket connection timeout ({COMFYUI_CONNECT_TIMEOUT_SECONDS} seconds)")
+            time.sleep(min(retry_delay(attempt, 0.25), remaining))
+            attempt += 1
     
     # Generate video
     videos = get_videos(ws, prompt)
+
+    # Start the R2 upload (and inline encoding, if requested) before tearing down the websocket
+    video_path = next((paths[0] for paths in videos.values() if paths), None)
+    upload_future = None
+    encode_future = None
+    if video_path:
+        upload_future = output_executor.submit(upload_output_video, video_path)
+        if job_input.get("return_video", True):
+            encode_future = output_executor.submit(encode_video_base64, video_path)
     ws.close()
 
-    # Find and return video
-    for node_id in videos:
-        if videos[node_id]:
-            video_base64 = videos[node_id][0]
-            
-            # Upload to R2 if configured
-            download_url = upload_output_video(video_base64)
-            
-            result = {
-                "status": "success",
-                "video": video_base64,
-                "task": task,
-                "resolution": f"{adjusted_width}x{adjusted_height}",
-                "num_frames": length,
-                "steps": steps,
-            }
-            
-            if download_url:
-                result["download_url"] = download_url
-            
-            return result
-    
-    return {"error": "Video not found in output"}
+    if not video_path:
+        return {"error": "Video not found in output"}
+
+    result = {
+        "status": "success",
+        "task": task,
+        "resolution": f"{adjusted_width}x{adjusted_height}",
+        "num_frames": length,
+        "steps": steps,
+    }
+
+    download_url = upload_future.result()
+    if download_url:
+        result["download_url"] = download_url
+
+    # Inline the video unless the job opted out with "return_video": false and has a download URL
+    if encode_future:
+        result["video"] = encode_future.result()
+    elif not download_url:
+        result["video"] = encode_video_base64(video_path)
+
+    return result
 
 runpod.serverless.start({"handler": handler})